@@ -25,11 +25,13 @@
 typedef struct{
   int ball_size;
   double *ball;
+  float *ball_f;
 } ballData;
 
 /* Function Declarations */
 void cleanup(ballData *);
-void estimateBg(ballData *, double *, double *, int, int);
+void estimateBg(ballData *, double *, double *, int, int, double);
+void estimateBgF32(ballData *, float *, float *, int, int, float);
 ballData* init(double *, int);
 
 
@@ -41,6 +43,7 @@ ballData* init(double *, int);
 void cleanup(ballData *ball_data)
 {
   free(ball_data->ball);
+  free(ball_data->ball_f);
   free(ball_data);
 }
 
@@ -49,11 +52,12 @@ void cleanup(ballData *ball_data)
  *
  * ball_data - Pointer to a ballData structure.
  * image - The image to estimate the background of.
- * background - Pre-initialized storage for the background estimate.
+ * background - Storage for the background estimate.
  * image_x - The size of the image in x (slow dimension).
  * image_y - The size of the image in y (fast dimension).
+ * offset - Value to add to the background estimate.
  */
-void estimateBg(ballData *ball_data, double *image, double *background, int image_x, int image_y)
+void estimateBg(ballData *ball_data, double *image, double *background, int image_x, int image_y, double offset)
 {
   int bb,cx,cy,i,j,k,l;
   double min,cur;
@@ -77,7 +81,48 @@ void estimateBg(ballData *ball_data, double *image, double *background, int imag
 	  }
 	}
       }
-      background[i*image_y+j] = min;
+      background[i*image_y+j] = min + offset;
+    }
+  }
+}
+
+/*
+ * estimateBgF32()
+ *
+ * Single precision version of estimateBg().
+ *
+ * ball_data - Pointer to a ballData structure.
+ * image - The image to estimate the background of.
+ * background - Storage for the background estimate.
+ * image_x - The size of the image in x (slow dimension).
+ * image_y - The size of the image in y (fast dimension).
+ * offset - Value to add to the background estimate.
+ */
+void estimateBgF32(ballData *ball_data, float *image, float *background, int image_x, int image_y, float offset)
+{
+  int bb,cx,cy,i,j,k,l;
+  float min,cur;
+
+  bb = (ball_data->ball_size - 1)/2;
+  
+  for(i=0;i<image_x;i++){
+    for(j=0;j<image_y;j++){
+      min = image[i*image_y+j];
+      for(k=0;k<ball_data->ball_size;k++){
+	cx = i + k - bb;
+	if (cx < 0) continue;
+	if (cx >= image_x) continue;
+	for(l=0;l<ball_data->ball_size;l++){
+	  cy = j + l - bb;
+	  if (cy < 0) continue;
+	  if (cy >= image_y) continue;
+	  cur = image[cx*image_y+cy] - ball_data->ball_f[k*ball_data->ball_size+l];
+	  if (cur < min){
+	    min = cur;
+	  }
+	}
+      }
+      background[i*image_y+j] = min + offset;
     }
   }
 }
@@ -98,9 +143,11 @@ ballData *init(double *py_ball, int py_ball_size)
   ball_data->ball_size = py_ball_size;
 
   ball_data->ball = (double *)malloc(sizeof(double) * ball_data->ball_size * ball_data->ball_size);
+  ball_data->ball_f = (float *)malloc(sizeof(float) * ball_data->ball_size * ball_data->ball_size);
 
   for (i=0;i<(ball_data->ball_size * ball_data->ball_size);i++){
     ball_data->ball[i] = py_ball[i];
+    ball_data->ball_f[i] = (float)py_ball[i];
   }
 
   return ball_data;
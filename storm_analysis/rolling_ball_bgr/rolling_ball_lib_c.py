@@ -8,6 +8,7 @@ Hazen 02/16
 import numpy
 import os
 import scipy
+import scipy.fft
 import scipy.ndimage
 
 import ctypes
@@ -25,41 +26,220 @@ rball.estimateBg.argtypes = [ctypes.c_void_p,
                              ndpointer(dtype=numpy.float64),
                              ndpointer(dtype=numpy.float64),
                              ctypes.c_int,
-                             ctypes.c_int]
+                             ctypes.c_int,
+                             ctypes.c_double]
+
+rball.estimateBgF32.argtypes = [ctypes.c_void_p,
+                                ndpointer(dtype=numpy.float32),
+                                ndpointer(dtype=numpy.float32),
+                                ctypes.c_int,
+                                ctypes.c_int,
+                                ctypes.c_float]
 
 rball.init.argtypes = [ndpointer(dtype=numpy.float64), 
                        ctypes.c_int]
 rball.init.restype = ctypes.c_void_p
 
 
+class RollingBallException(Exception):
+    pass
+
+
+def createBall(ball_radius):
+    """
+    Returns the ball (height as a function of x,y) for this ball radius.
+    """
+    ball_size = int(round(ball_radius * 0.5))
+    br = ball_radius * ball_radius
+    dx, dy = numpy.ogrid[-ball_size:ball_size+1, -ball_size:ball_size+1]
+    return numpy.sqrt(numpy.maximum(br - (dx * dx + dy * dy), 0.0))
+
+    
+def gaussianKernel1D(sigma, truncate = 4.0):
+    """
+    Returns the (normalized) 1D gaussian kernel that scipy.ndimage.gaussian_filter()
+    would use for this sigma.
+    """
+    if (sigma <= 0.0):
+        return numpy.ones(1)
+    
+    radius = int(truncate * sigma + 0.5)
+    x = numpy.arange(-radius, radius+1)
+    kernel = numpy.exp(-0.5 * x * x / (sigma * sigma))
+    return kernel/numpy.sum(kernel)
+
+
 class CRollingBall(object):
+    """
+    Rolling ball background estimation using rolling_ball_lib.c.
 
+    The image buffers (self.buffers) and the gaussian kernel FFTs (self.g_ffts)
+    are cached for each image shape (and type) that is processed. These are
+    never freed, so memory usage will keep growing if the image shape changes
+    a lot. Use a new object in that case.
+    """
     def __init__(self, ball_radius, smoothing_sigma):
         self.ball_radius = ball_radius
+        self.buffers = {}
+        self.g_ffts = {}
         self.smoothing_sigma = smoothing_sigma
 
-        ball_size = int(round(ball_radius * 0.5))
-        br = ball_radius * ball_radius
-        ball = numpy.zeros((2*ball_size+1, 2*ball_size+1))
-        for x in range(2*ball_size+1):
-            dx = x - ball_size
-            for y in range(2*ball_size+1):
-                dy = y - ball_size
-                ball[x,y] = br - (dx * dx + dy * dy)
-        ball = numpy.sqrt(ball)
+        self.ball = createBall(ball_radius)
+        self.c_rball = rball.init(self.ball, self.ball.shape[0])
 
-        self.c_rball = rball.init(ball, 2*ball_size+1)
+        # Gaussian smoothing kernel, this is the same for every frame.
+        self.g_weights = gaussianKernel1D(smoothing_sigma)
 
     def cleanup(self):
         rball.cleanup(self.c_rball)
         self.c_rball = None
+
+    def getBuffers(self, shape, dtype):
+        """
+        Returns the (converted, temporary, smoothed) image buffers for this
+        image shape and type, these are re-used for all the frames of the
+        same size.
+        """
+        key = (shape, dtype)
+        if not key in self.buffers:
+            self.buffers[key] = [numpy.zeros(shape, dtype = dtype),
+                                 numpy.zeros(shape, dtype = dtype),
+                                 numpy.zeros(shape, dtype = dtype)]
+        return self.buffers[key]
         
     def estimateBG(self, image):
-        image = image.astype(numpy.float64)
-        sm_image = scipy.ndimage.gaussian_filter(image, self.smoothing_sigma)
-        ball_image = numpy.zeros((image.shape))
-        rball.estimateBg(self.c_rball, sm_image, ball_image, sm_image.shape[0], sm_image.shape[1])
-        return ball_image + self.ball_radius
+        sm_image = self._smoothImage(image)
+        if (sm_image.dtype == numpy.float64):
+            estimate_bg = rball.estimateBg
+        else:
+            estimate_bg = rball.estimateBgF32
+
+        # The C library adds ball_radius as it stores the background estimate.
+        ball_image = numpy.empty_like(sm_image)
+        estimate_bg(self.c_rball, sm_image, ball_image, sm_image.shape[0], sm_image.shape[1], self.ball_radius)
+        return ball_image
+
+    def removeBG(self, image):
+        return image - self.estimateBG(image)
+
+    def smoothImage(self, image):
+        """
+        Returns (a copy of) the smoothed image.
+        """
+        return numpy.copy(self._smoothImage(image))
+
+    def _smoothImage(self, image):
+        """
+        Returns the smoothed image. This is one of the cached buffers so it
+        will be overwritten by the next call with an image of the same shape.
+        """
+        # float32 and uint16 (camera frames) images, which float32 represents
+        # exactly, are processed in single precision. Everything else is
+        # processed in double precision.
+        #
+        if (image.dtype == numpy.float32) or (image.dtype == numpy.uint16):
+            dtype = numpy.float32
+        else:
+            dtype = numpy.float64
+        [float_image, tmp_image, sm_image] = self.getBuffers(image.shape, dtype)
+
+        if (image.dtype != dtype):
+            numpy.copyto(float_image, image)
+            image = float_image
+
+        # Gaussian smoothing, equivalent to scipy.ndimage.gaussian_filter(). For
+        # large sigma FFT convolution is faster than separable convolution.
+        #
+        if (self.smoothing_sigma > 3.0):
+            sm_image[:,:] = self.smoothImageFFT(image)
+        else:
+            scipy.ndimage.correlate1d(image, self.g_weights, axis = 0, output = tmp_image)
+            scipy.ndimage.correlate1d(tmp_image, self.g_weights, axis = 1, output = sm_image)
+
+        return sm_image
+
+    def smoothImageFFT(self, image):
+        """
+        Gaussian smoothing using FFT convolution. The image is padded by reflection
+        to match the boundary handling of scipy.ndimage.gaussian_filter().
+        """
+        g_size = (self.g_weights.size - 1)//2
+        [fft_shape, g_fft] = self.getGaussianFFT(image.shape)
+        
+        padded = numpy.pad(image, g_size, mode = 'symmetric')
+        conv = scipy.fft.irfft2(scipy.fft.rfft2(padded, s = fft_shape, workers = -1) * g_fft,
+                                s = fft_shape,
+                                workers = -1)
+        return conv[2*g_size:2*g_size+image.shape[0], 2*g_size:2*g_size+image.shape[1]]
+
+    def getGaussianFFT(self, shape):
+        """
+        Returns the FFT size and the FFT of the gaussian smoothing kernel for
+        this image shape, these are re-used for all the frames of the same size.
+        """
+        if not shape in self.g_ffts:
+            fft_shape = []
+            for elt in shape:
+                fft_shape.append(scipy.fft.next_fast_len(elt + 2*(self.g_weights.size - 1), real = True))
+
+            g_kernel = numpy.outer(self.g_weights, self.g_weights)
+            self.g_ffts[shape] = [fft_shape, scipy.fft.rfft2(g_kernel, s = fft_shape)]
+        return self.g_ffts[shape]
+
+
+class CRollingBallGPU(object):
+    """
+    Rolling ball background estimation on a GPU using CuPy and cuCIM.
+
+    The smoothing and the rolling ball are both done on the GPU so the
+    image is only transferred once in each direction.
+
+    CuPy and cuCIM are optional, they are only imported when this class
+    is used.
+
+    Note that this has not been tested on a GPU. The equivalence with
+    CRollingBall.estimateBG() assumes that cuCIM's rolling_ball() behaves
+    like scikit-image's, i.e. that it returns the minimum of
+    (image - kernel) over the kernel footprint plus the kernel center
+    value (ball_radius). test_rolling_ball_gpu() checks this when CuPy and
+    cuCIM are installed.
+    """
+    def __init__(self, ball_radius, smoothing_sigma, **kwds):
+        super(CRollingBallGPU, self).__init__(**kwds)
+        self.ball_radius = ball_radius
+        self.smoothing_sigma = smoothing_sigma
+
+        # A broken CUDA installation can raise other exceptions than ImportError.
+        try:
+            import cupy
+            import cupyx.scipy.ndimage
+            import cucim.skimage.restoration
+            self.ball_d = cupy.asarray(createBall(ball_radius))
+        except Exception as e:
+            raise RollingBallException("CRollingBallGPU requires CuPy and cuCIM.") from e
+
+        self.cupy = cupy
+        self.cupy_ndimage = cupyx.scipy.ndimage
+        self.cucim_restoration = cucim.skimage.restoration
+
+    def cleanup(self):
+        self.ball_d = None
+        
+    def estimateBG(self, image):
+        if (image.dtype == numpy.float32) or (image.dtype == numpy.uint16):
+            image = image.astype(numpy.float32, copy = False)
+        else:
+            image = image.astype(numpy.float64, copy = False)
+        image_d = self.cupy.asarray(image)
+
+        sm_image_d = self.cupy_ndimage.gaussian_filter(image_d, self.smoothing_sigma)
+
+        # cuCIM's (and scikit-image's) rolling_ball() add the height of the
+        # center of the ball, which is ball_radius, to the minimum so this
+        # should be the same as CRollingBall.estimateBG().
+        #
+        ball_image_d = self.cucim_restoration.rolling_ball(sm_image_d, kernel = self.ball_d)
+        return self.cupy.asnumpy(ball_image_d)
 
     def removeBG(self, image):
         return image - self.estimateBG(image)
@@ -67,11 +247,23 @@ class CRollingBall(object):
 
 if (__name__ == "__main__"):
 
-    # A very simple test.
+    import time
+    
+    # A very simple test. This processes the same image many times so that
+    # it also exercises re-using the image buffers.
+    #
     test = 100.0 * numpy.ones((100,100))
     rb = CRollingBall(10, 0.5)
-    test = rb.removeBG(test)
-    print(numpy.min(test), numpy.max(test))
+
+    n_frames = 100
+    start_time = time.time()
+    for i in range(n_frames):
+        result = rb.removeBG(test)
+    elapsed = time.time() - start_time
+    
+    print(numpy.min(result), numpy.max(result))
+    print("{0:.3f}ms per frame".format(1000.0 * elapsed/n_frames))
+    assert numpy.allclose(result, 0.0)
     rb.cleanup()
     
 
@@ -17,6 +17,7 @@ rqe - AU
 Hazen 05/18
 """
 
+import concurrent.futures
 import matplotlib
 import matplotlib.pyplot as pyplot
 import numpy
@@ -26,14 +27,43 @@ import scipy
 import scipy.ndimage
 import sys
 
+# numba is optional, it is only used to speed up the gain fit.
+try:
+    import numba
+except ImportError:
+    numba = None
 
-def cameraCalibration(scmos_files, show_fit_plots = True, show_mean_plots = True):
+
+def boxFilter(image, size):
+    """
+    Box filter an image using a summed area table. This gives the same result
+    as scipy.ndimage.uniform_filter(image, size = size, mode = 'nearest').
+    """
+    lo = size//2
+    hi = size - lo - 1
+
+    # Pad with the edge values, plus an extra row and column of zeros at
+    # the start so that the table starts from 0.
+    padded = numpy.pad(image.astype(numpy.float64), ((lo+1, hi), (lo+1, hi)), mode = 'edge')
+    padded[0,:] = 0.0
+    padded[:,0] = 0.0
+
+    sat = numpy.cumsum(padded, axis = 0)
+    numpy.cumsum(sat, axis = 1, out = sat)
+
+    return (sat[size:,size:] - sat[:-size,size:] - sat[size:,:-size] + sat[:-size,:-size])/(size*size)
+    
+
+def cameraCalibration(scmos_files, show_fit_plots = True, show_mean_plots = True, prefetch = False):
     """
     Calculate camera calibration.
 
     scmos_files - A list of calibration files [dark, light1, light2, ..]
     show_fit_plots - Show (a few) plots of the fits for the pixel gain.
     show_mean_plots - Show mean of intensity versus frame for the calibration files (if available).
+    prefetch - Read the next calibration file while processing the current one. This
+               is faster but means that two files are in memory at the same time,
+               so it is off by default.
     """
     n_frames = None
     n_points = len(scmos_files)
@@ -47,96 +77,227 @@ def cameraCalibration(scmos_files, show_fit_plots = True, show_mean_plots = True
 
     # Load the data files.
     #
-    for i, a_file in enumerate(scmos_files):
-        print(i, "loading", a_file)
-
-        [n_frames, pixel_mean, pixel_var] = loadCalibrationData(a_file,
-                                                                is_dark = (i == 0),
-                                                                print_roi_info = (i == 0),
-                                                                show_mean_plots = show_mean_plots)
-
-        if all_means is None:
-            all_means = numpy.zeros((pixel_mean.shape[0], pixel_mean.shape[1], n_points))
-            all_vars = numpy.zeros_like(all_means)
-
-        # Other files have the dark calibration offset and variance subtracted.
-        if (i > 0):
-            all_means[:,:,i] = pixel_mean - offset
-            all_vars[:,:,i] = pixel_var - variance
+    # If prefetch is True the next file is read in a background thread while
+    # the current file is being processed, so the peak memory usage is the
+    # data from two files.
+    #
+    executor = None
+    if prefetch:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        next_file_data = executor.submit(readCalibrationFile, scmos_files[0])
+
+    try:
+        for i, a_file in enumerate(scmos_files):
+            print(i, "processing", a_file)
+
+            if prefetch:
+                file_data = next_file_data.result()
+                if ((i + 1) < n_points):
+                    next_file_data = executor.submit(readCalibrationFile, scmos_files[i+1])
+            else:
+                file_data = readCalibrationFile(a_file)
+            
+            [n_frames, pixel_mean, pixel_var] = loadCalibrationData(a_file,
+                                                                    is_dark = (i == 0),
+                                                                    print_roi_info = (i == 0),
+                                                                    show_mean_plots = show_mean_plots,
+                                                                    file_data = file_data)
+
+            # Single precision is sufficient for the (offset subtracted) values
+            # used in the gain fit.
+            #
+            # These are stored as (n_points, nx, ny) so that each calibration
+            # file is a contiguous plane.
+            if all_means is None:
+                all_means = numpy.zeros((n_points, pixel_mean.shape[0], pixel_mean.shape[1]), dtype = numpy.float32)
+                all_vars = numpy.zeros_like(all_means)
+
+            # Other files have the dark calibration offset and variance subtracted.
+            if (i > 0):
+                numpy.subtract(pixel_mean, offset, out = all_means[i])
+                numpy.subtract(pixel_var, variance, out = all_vars[i])
+
+                print("  average pixel variance {0:.3f}".format(numpy.mean(all_vars[i], dtype = numpy.float64)))
+
+            # The first file is assumed to be the dark calibration file.
+            else:
+                offset = pixel_mean
+                variance = pixel_var
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-            print("  average pixel variance {0:.3f}".format(numpy.mean(pixel_var - variance)))
+    # Fit for gain.
+    nx = all_means.shape[1]
+    ny = all_means.shape[2]
 
-        # The first file is assumed to be the dark calibration file.
-        else:
-            offset = pixel_mean
-            variance = pixel_var
+    for [i, j] in numpy.argwhere(numpy.count_nonzero(all_means, axis = 0) == 0):
+        print("Bad pixel detected at", i, j, "using gain = 1.0")
 
-    # Fit for gain.
-    gain = numpy.zeros((all_means.shape[0], all_means.shape[1]))
-    nx = all_means.shape[0]
-    ny = all_means.shape[1]
-    for i in range(nx):
-        for j in range(ny):
-            if (numpy.count_nonzero(all_means[i,j,:]) > 0):
-                gain[i,j] = numpy.polyfit(all_means[i,j,:], all_vars[i,j,:], 1)[0]
-            else:
-                print("Bad pixel detected at", i, j, "using gain = 1.0")
-                gain[i,j] = 1.0
+    [gain, intercept] = fitGain(all_means, all_vars)
 
-            if (((i*ny+j) % 1000) == 0):
-                print("pixel", i, j,
-                      "offset {0:.3f} variance {1:.3f} gain {2:.3f}".format(offset[i,j,],
-                                                                            variance[i,j],
-                                                                            gain[i,j]))
+    for k in range(0, nx*ny, 1000):
+        [i, j] = divmod(k, ny)
+        print("pixel", i, j,
+              "offset {0:.3f} variance {1:.3f} gain {2:.3f}".format(offset[i,j],
+                                                                    variance[i,j],
+                                                                    gain[i,j]))
 
     if show_fit_plots:
         print("")
+        [fig, axes] = pyplot.subplots(1, 5, figsize = (15, 3), tight_layout = True)
         for i in range(5):
-            pyplot.figure()
-
-            data_x = all_means[i,0,:]
-            data_y = all_vars[i,0,:]
-            fit = numpy.polyfit(data_x, data_y, 1)
+            data_x = all_means[:,i,0]
+            data_y = all_vars[:,i,0]
 
-            print(i, "gain {0:.3f}".format(fit[0]))
-            pyplot.scatter(data_x,
-                           data_y,
-                           marker = 'o',
-                           s = 2)
+            print(i, "gain {0:.3f}".format(gain[i,0]))
+            axes[i].scatter(data_x,
+                            data_y,
+                            marker = 'o',
+                            s = 2)
 
             xf = numpy.array([0, data_x[-1]])
-            yf = xf * fit[0] + fit[1]
+            yf = xf * gain[i,0] + intercept[i,0]
             
-            pyplot.plot(xf, yf, color = 'blue')
-            pyplot.xlabel("Mean Intensity (ADU).")
-            pyplot.ylabel("Mean Variance (ADU).")
+            axes[i].plot(xf, yf, color = 'blue')
+            axes[i].set_xlabel("Mean Intensity (ADU).")
+            axes[i].set_ylabel("Mean Variance (ADU).")
             
-            pyplot.show()
+        pyplot.show()
 
     # Fit for relative QE.
     #
     # This uses the last of the files, which is assumed to be the brightest.
+    # pixel_mean is still the mean of this file from the loading loop above.
     #
-    [n_frames, pixel_mean, pixel_var] = loadCalibrationData(scmos_files[-1])
     corrected_image = (pixel_mean - offset)/gain
-    smoothed_image = scipy.ndimage.uniform_filter(corrected_image, size = 10, mode = 'nearest')
+    smoothed_image = boxFilter(corrected_image, 10)
     relative_qe = corrected_image/smoothed_image
     
     return [offset, variance, gain, relative_qe]
 
 
-def loadCalibrationData(filename, is_dark = False, print_roi_info = False, show_mean_plots = False):
+def fitGain(all_means, all_vars):
+    """
+    Linear least squares fit of variance versus mean for every pixel, this
+    uses the closed form solution for the slope and intercept.
+
+    all_means - Pixel means, (n_points, nx, ny).
+    all_vars - Pixel variances, (n_points, nx, ny).
+
+    Returns [slope, intercept] for every pixel. The slope (gain) is 1.0
+    for pixels whose means are all zero (bad pixels).
+    """
+    gain = numpy.zeros(all_means.shape[1:])
+    intercept = numpy.zeros(all_means.shape[1:])
+
+    if numba is not None:
+        fitGainNumba(all_means, all_vars, gain, intercept)
+        return [gain, intercept]
+
+    # Without numba, divide the rows into tiles and fit each tile in a
+    # separate thread. numpy releases the GIL for these calculations.
+    #
+    nx = all_means.shape[1]
+    n_tiles = max(1, min(os.cpu_count() or 1, nx))
+    edges = numpy.linspace(0, nx, n_tiles + 1).astype(int)
+    with concurrent.futures.ThreadPoolExecutor(max_workers = n_tiles) as executor:
+        futures = []
+        for i in range(n_tiles):
+            [s, e] = edges[i:i+2]
+            futures.append(executor.submit(fitGainTile,
+                                           all_means[:,s:e],
+                                           all_vars[:,s:e],
+                                           gain[s:e],
+                                           intercept[s:e]))
+        for future in futures:
+            future.result()
+
+    return [gain, intercept]
+
+
+def fitGainTile(all_means, all_vars, gain, intercept):
+    """
+    fitGain() calculation for a tile of rows, the results are stored
+    in gain and intercept.
+    """
+    good = (numpy.count_nonzero(all_means, axis = 0) > 0)
+
+    x_mean = numpy.mean(all_means, axis = 0, dtype = numpy.float64)
+    y_mean = numpy.mean(all_vars, axis = 0, dtype = numpy.float64)
+    dx = all_means - x_mean
+    dy = all_vars - y_mean
+
+    gain[:,:] = 1.0
+    gain[good] = numpy.sum(dx*dy, axis = 0)[good]/numpy.sum(dx*dx, axis = 0)[good]
+    intercept[:,:] = y_mean - gain * x_mean
+
+
+if numba is not None:
+    @numba.njit(parallel = True, cache = True, error_model = 'numpy')
+    def fitGainNumba(all_means, all_vars, gain, intercept):
+        """
+        numba version of the fitGain() calculation. This does the fit for
+        each pixel in a single pass, with the rows divided between threads.
+        Each row is accumulated one calibration point at a time so that the
+        memory access is contiguous.
+
+        The compiled function is cached so it is only compiled once. Division
+        by zero (pixels with constant non-zero means) gives inf or NaN as in
+        the numpy version, instead of raising an exception.
+        """
+        [n_points, nx, ny] = all_means.shape
+        for i in numba.prange(nx):
+            n_nonzero = numpy.zeros(ny, dtype = numpy.int64)
+            sx = numpy.zeros(ny)
+            sy = numpy.zeros(ny)
+            sxx = numpy.zeros(ny)
+            sxy = numpy.zeros(ny)
+            for k in range(n_points):
+                for j in range(ny):
+                    x = all_means[k,i,j]
+                    y = all_vars[k,i,j]
+                    if (x != 0.0):
+                        n_nonzero[j] += 1
+                    sx[j] += x
+                    sy[j] += y
+                    sxx[j] += x*x
+                    sxy[j] += x*y
+            for j in range(ny):
+                if (n_nonzero[j] > 0):
+                    gain[i,j] = (n_points*sxy[j] - sx[j]*sy[j])/(n_points*sxx[j] - sx[j]*sx[j])
+                else:
+                    gain[i,j] = 1.0
+                intercept[i,j] = (sy[j] - gain[i,j]*sx[j])/n_points
+
+
+def integerVariance(x, xx, n_frames):
+    """
+    Returns True if the variance can be calculated exactly in 64 bit
+    integers from the sums x and xx.
+    """
+    for elt in [x, xx]:
+        if not numpy.issubdtype(elt.dtype, numpy.integer):
+            return False
+        if (elt.size > 0) and (numpy.min(elt) < 0):
+            return False
+    if (xx.size == 0):
+        return True
+    return ((int(numpy.max(xx)) * int(n_frames)) < numpy.iinfo(numpy.int64).max)
+
+
+def loadCalibrationData(filename, is_dark = False, print_roi_info = False, show_mean_plots = False, file_data = None):
     """
     Load data.
-    
-    Originally this was a list of length 3. Later we added a 4th element
-    which is a dictionary containing some information about the camera ROI.
+
+    file_data - The result of readCalibrationFile(filename), if this has
+                already been read.
     """
-    all_data = numpy.load(filename, allow_pickle = True)
-    if (len(all_data) == 3):
-        [data, x, xx] = all_data
-    else:
-        [data, x, xx, roi_dict] = all_data
+    if file_data is None:
+        file_data = readCalibrationFile(filename)
+        
+    [data, x, xx, roi_dict] = file_data
+    if roi_dict is not None:
         if print_roi_info:
             print("Calibration ROI info:")
             for key in sorted(roi_dict):
@@ -167,14 +328,52 @@ def loadCalibrationData(filename, is_dark = False, print_roi_info = False, show_
             pyplot.ylabel("Mean Intensity (ADU)")
             pyplot.show()
 
-    x = x.astype(numpy.float64)
-    xx = xx.astype(numpy.float64)
-    pixel_mean = x/float(n_frames)
-    pixel_var = xx/float(n_frames) - pixel_mean * pixel_mean - mean_var
+    # This is done in double precision and in place to limit the number
+    # of temporary arrays. Single precision is not accurate enough here as
+    # the variance is a small difference of two large numbers.
+    #
+    pixel_mean = numpy.divide(x, float(n_frames), dtype = numpy.float64)
+
+    # If the sums are integers, as they are for camera data, the variance
+    # numerator (n*xx - x*x) can be calculated exactly in 64 bit integers,
+    # provided that this won't overflow (x*x <= n*xx).
+    #
+    if integerVariance(x, xx, n_frames):
+        pixel_var = numpy.multiply(xx, int(n_frames), dtype = numpy.int64)
+        pixel_var -= numpy.multiply(x, x, dtype = numpy.int64)
+        pixel_var = numpy.divide(pixel_var, float(n_frames) * float(n_frames), dtype = numpy.float64)
+    else:
+        pixel_var = numpy.divide(xx, float(n_frames), dtype = numpy.float64)
+        pixel_var -= pixel_mean * pixel_mean
+    pixel_var -= mean_var
 
     return [n_frames, pixel_mean, pixel_var]
 
 
+def readCalibrationFile(filename):
+    """
+    Read a calibration file, returns [data, x, xx, roi_dict]. roi_dict
+    is None if the file does not contain this information.
+
+    Originally this was a pickled list of length 3. Later we added a 4th
+    element which is a dictionary containing some information about the
+    camera ROI. Calibration files can also be .npz files containing the
+    'data', 'x' and 'xx' arrays, these can be read without unpickling.
+
+    Note that neither format can be memory mapped by numpy, the arrays
+    are read into memory.
+    """
+    if filename.endswith(".npz"):
+        with numpy.load(filename) as npz:
+            return [npz["data"], npz["x"], npz["xx"], None]
+        
+    all_data = numpy.load(filename, allow_pickle = True)
+    if (len(all_data) == 3):
+        return list(all_data) + [None]
+    else:
+        return list(all_data)
+
+
 if (__name__ == "__main__"):
 
     import argparse
@@ -185,6 +384,8 @@ if (__name__ == "__main__"):
                         help = "The name of the numpy format file to save the results in.")
     parser.add_argument('--cal', nargs = "*", dest='cal', type=str, required=True,
                         help = "Storm-control format calibration files, in order dark, light1, light2, ...")
+    parser.add_argument('--prefetch', dest='prefetch', action='store_true', default=False,
+                        help = "Read the next calibration file in the background, this is faster but uses more memory.")
 
     args = parser.parse_args()
 
@@ -192,7 +393,7 @@ if (__name__ == "__main__"):
         print("Calibration file already exists, please delete before proceeding.")
         exit()
     
-    [offset, variance, gain, rqe] = cameraCalibration(args.cal)
+    [offset, variance, gain, rqe] = cameraCalibration(args.cal, prefetch = args.prefetch)
 
     with open(args.results, "wb") as fp:
         pickle.dump([offset, variance, gain, rqe, 2], fp)
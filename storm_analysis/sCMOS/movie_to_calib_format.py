@@ -56,15 +56,18 @@ if (__name__ == "__main__"):
     parser.add_argument('--movie', dest='movie', type=str, required=True,
                         help = "The name of the movie.")
     parser.add_argument('--cal', dest='cal', type=str, required=True,
-                        help = "The name of the calibration input file.")
+                        help = "The name of the calibration input file, use a .npz extension to save as a .npz file.")
 
     args = parser.parse_args()
 
     [frame_mean, N, NN] = movieToCalibration(args.movie)
 
     # Save the results.
-    with open(args.cal, "wb") as fp:
-        pickle.dump([frame_mean, N, NN], fp)
+    if args.cal.endswith(".npz"):
+        numpy.savez(args.cal, data = frame_mean, x = N, xx = NN)
+    else:
+        with open(args.cal, "wb") as fp:
+            pickle.dump([frame_mean, N, NN], fp)
 
     mean = N/float(frame_mean.size)
     print("Mean:", numpy.mean(mean))
@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 
+import numpy
+import pytest
+import scipy.ndimage
+
 import storm_analysis
 
 
@@ -12,7 +16,105 @@ def test_rolling_ball():
     rollingBallSub(movie_in, movie_out, 10, 1)
 
 
+def test_rolling_ball_smoothing():
+    """
+    Test that the cached smoothing kernel matches scipy.ndimage.gaussian_filter().
+    """
+    import storm_analysis.rolling_ball_bgr.rolling_ball_lib_c as rollingBallLibC
+
+    image = numpy.random.uniform(size = (40,50))
+    for sigma in [0.5, 1.0, 2.5]:
+        kernel = rollingBallLibC.gaussianKernel1D(sigma)
+        sm_image = scipy.ndimage.correlate1d(image, kernel, axis = 0)
+        sm_image = scipy.ndimage.correlate1d(sm_image, kernel, axis = 1)
+        assert numpy.allclose(sm_image, scipy.ndimage.gaussian_filter(image, sigma))
+
+    # Large sigma values use FFT convolution.
+    rb = rollingBallLibC.CRollingBall(10, 4.0)
+    sm_image = rb.smoothImage(image)
+    rb.cleanup()
+    assert numpy.allclose(sm_image, scipy.ndimage.gaussian_filter(image, 4.0))
+
+
+def test_rolling_ball_float32():
+    """
+    Test that single and double precision background estimates agree.
+    """
+    import storm_analysis.rolling_ball_bgr.rolling_ball_lib_c as rollingBallLibC
+
+    image = 1000.0 * numpy.random.uniform(size = (40,50))
+    rb = rollingBallLibC.CRollingBall(10, 1.0)
+    bg_f64 = rb.estimateBG(image)
+    bg_f32 = rb.estimateBG(image.astype(numpy.float32))
+    rb.cleanup()
+
+    assert (bg_f64.dtype == numpy.float64)
+    assert (bg_f32.dtype == numpy.float32)
+    assert numpy.allclose(bg_f32, bg_f64, atol = 1.0e-3)
+
+    # Only uint16 integer images use single precision.
+    rb = rollingBallLibC.CRollingBall(10, 1.0)
+    assert (rb.estimateBG(image.astype(numpy.uint16)).dtype == numpy.float32)
+    assert (rb.estimateBG(image.astype(numpy.int64)).dtype == numpy.float64)
+    rb.cleanup()
+
+
+def test_rolling_ball_buffers():
+    """
+    Test that re-using the image buffers does not change earlier results.
+    """
+    import storm_analysis.rolling_ball_bgr.rolling_ball_lib_c as rollingBallLibC
+
+    image1 = numpy.random.randint(100, 1000, size = (40,50)).astype(numpy.uint16)
+    image2 = numpy.random.randint(100, 1000, size = (40,50)).astype(numpy.uint16)
+    
+    rb = rollingBallLibC.CRollingBall(10, 1.0)
+    bg1 = rb.estimateBG(image1)
+    bg1_copy = numpy.copy(bg1)
+    bg2 = rb.estimateBG(image2)
+    bg1_again = rb.estimateBG(image1)
+    rb.cleanup()
+
+    assert numpy.allclose(bg1, bg1_copy)
+
+    # Smoothed images that are kept should not change either.
+    rb = rollingBallLibC.CRollingBall(10, 1.0)
+    sm1 = rb.smoothImage(image1)
+    sm1_copy = numpy.copy(sm1)
+    rb.smoothImage(image2)
+    rb.cleanup()
+    assert numpy.allclose(sm1, sm1_copy)
+    assert numpy.allclose(bg1, bg1_again)
+    assert not numpy.allclose(bg1, bg2)
+
+    
+def test_rolling_ball_gpu():
+    """
+    Test that the GPU background estimate matches CRollingBall.
+    """
+    pytest.importorskip("cupy")
+    pytest.importorskip("cucim")
+    
+    import storm_analysis.rolling_ball_bgr.rolling_ball_lib_c as rollingBallLibC
+
+    image = numpy.random.poisson(50, size = (128,128)).astype(numpy.float64) + 100.0
+    image[:,64:] += 1000.0
+
+    rb = rollingBallLibC.CRollingBall(10, 1.0)
+    rb_gpu = rollingBallLibC.CRollingBallGPU(10, 1.0)
+    bg = rb.estimateBG(image)
+    bg_gpu = rb_gpu.estimateBG(image)
+    rb.cleanup()
+    rb_gpu.cleanup()
+
+    assert numpy.allclose(bg, bg_gpu, atol = 1.0e-3)
+
+    
 if (__name__ == "__main__"):
     test_rolling_ball()
+    test_rolling_ball_smoothing()
+    test_rolling_ball_float32()
+    test_rolling_ball_buffers()
+    test_rolling_ball_gpu()
 
 
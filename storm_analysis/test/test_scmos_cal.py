@@ -5,7 +5,9 @@ sCMOS calibration tests.
 import numpy
 import numpy.random
 import pickle
+import scipy.ndimage
 import tifffile
+import warnings
 
 import storm_analysis
 
@@ -196,6 +198,66 @@ def test_cam_cal_3():
     assert(numpy.allclose(cal_rqe, numpy.ones(size)))
 
 
+def test_cam_cal_4():
+    """
+    Calibration file format 3 (.npz).
+    """
+    size = (12,10)
+    cam_gain = 1.5 * numpy.ones(size)
+    cam_offset = 1000.0 * numpy.ones(size)
+    cam_var = 2.0 * numpy.ones(size)
+    n_frames = 20000
+    
+    # Create calibration files.
+    scmos_files = []
+    for i, name in enumerate(["dark.npz", "light1.npz", "light2.npz", "light3.npz", "light4.npz"]):
+        f_name = storm_analysis.getPathOutputTest(name)
+        scmos_files.append(f_name)
+        
+        mean = i * 500 * cam_gain
+        var = mean * cam_gain + cam_var
+        mean += cam_offset
+
+        N = mean * n_frames
+        NN = (var + mean*mean) * n_frames
+
+        mean_mean = numpy.zeros(n_frames) + numpy.mean(mean)
+        numpy.savez(f_name, data = mean_mean, x = N, xx = NN)
+
+    # Check, with and without reading the next file in the background.
+    for prefetch in [True, False]:
+        [cal_offset, cal_var, cal_gain, cal_rqe] = camCal.cameraCalibration(scmos_files,
+                                                                            show_fit_plots = False,
+                                                                            show_mean_plots = False,
+                                                                            prefetch = prefetch)
+
+        assert(numpy.allclose(cal_offset, cam_offset))
+        assert(numpy.allclose(cal_var, cam_var))
+        assert(numpy.allclose(cal_gain, cam_gain))
+        assert(numpy.allclose(cal_rqe, numpy.ones(size)))
+
+
+def test_cam_cal_integer():
+    """
+    Test that integer sums give the exact pixel variance.
+    """
+    frames = numpy.random.randint(10000, 10010, size = (1000,6,5)).astype(numpy.int64)
+    N = numpy.sum(frames, axis = 0)
+    NN = numpy.sum(frames*frames, axis = 0)
+    assert(camCal.integerVariance(N, NN, frames.shape[0]))
+
+    f_name = storm_analysis.getPathOutputTest("integer.npz")
+    numpy.savez(f_name, data = numpy.array([frames.shape[0]]), x = N, xx = NN)
+
+    [n_frames, pixel_mean, pixel_var] = camCal.loadCalibrationData(f_name)
+    assert(numpy.allclose(pixel_mean, numpy.mean(frames, axis = 0), atol = 0.0, rtol = 1.0e-14))
+    assert(numpy.allclose(pixel_var, numpy.var(frames, axis = 0), atol = 0.0, rtol = 1.0e-12))
+
+    # These would overflow.
+    assert(not camCal.integerVariance(N, NN, 2**62))
+    assert(not camCal.integerVariance(N.astype(numpy.float64), NN, n_frames))
+
+
 def test_bad_pixel():
     """
     Test bad pixel handling.
@@ -236,6 +298,67 @@ def test_bad_pixel():
     assert(numpy.allclose(cal_offset, cam_offset))
     assert(numpy.allclose(cal_var, cam_var))
     assert(numpy.allclose(cal_gain, cam_gain))
+
+
+def test_box_filter():
+    """
+    Test summed area table box filter against scipy.ndimage.uniform_filter().
+    """
+    image = numpy.random.uniform(size = (23,31))
+    for size in [7, 10]:
+        expected = scipy.ndimage.uniform_filter(image, size = size, mode = 'nearest')
+        assert(numpy.allclose(camCal.boxFilter(image, size), expected))
+
+        # Also check against the mean of every (edge padded) window.
+        lo = size//2
+        hi = size - lo - 1
+        padded = numpy.pad(image, ((lo, hi), (lo, hi)), mode = 'edge')
+        windows = numpy.lib.stride_tricks.sliding_window_view(padded, (size, size))
+        assert(numpy.allclose(camCal.boxFilter(image, size), numpy.mean(windows, axis = (2,3))))
+
+    
+def test_fit_gain():
+    """
+    Test gain fitting against numpy.polyfit().
+    """
+    all_means = numpy.random.uniform(size = (4,6,5))
+    all_vars = 2.0 * all_means + numpy.random.normal(scale = 0.1, size = all_means.shape)
+    all_means[:,1,2] = 0.0
+    good = numpy.ones(all_means.shape[1:], dtype = bool)
+    good[1,2] = False
+
+    expected = numpy.ones(all_means.shape[1:])
+    expected_int = numpy.zeros(all_means.shape[1:])
+    for i in range(all_means.shape[1]):
+        for j in range(all_means.shape[2]):
+            if good[i,j]:
+                [expected[i,j], expected_int[i,j]] = numpy.polyfit(all_means[:,i,j], all_vars[:,i,j], 1)
+
+    # A pixel whose means are constant, but not zero, has no defined slope.
+    const_means = numpy.copy(all_means)
+    const_means[:,3,4] = 0.1
+
+    def checkFit():
+        [gain, intercept] = camCal.fitGain(all_means, all_vars)
+        assert(numpy.allclose(gain, expected))
+        assert(numpy.allclose(intercept[good], expected_int[good]))
+
+        # The numpy version warns about the division by zero (in a worker thread).
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            [gain, intercept] = camCal.fitGain(const_means, all_vars)
+        assert(not numpy.isfinite(gain[3,4]))
+
+    checkFit()
+
+    # Also check the pure numpy version if numba is available.
+    if camCal.numba is not None:
+        numba = camCal.numba
+        try:
+            camCal.numba = None
+            checkFit()
+        finally:
+            camCal.numba = numba
     
     
 if (__name__ == "__main__"):
@@ -245,6 +368,10 @@ if (__name__ == "__main__"):
     test_cam_cal_1()
     test_cam_cal_2()
     test_cam_cal_3()
+    test_cam_cal_4()
+    test_cam_cal_integer()
     test_bad_pixel()
+    test_box_filter()
+    test_fit_gain()
     
     